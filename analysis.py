@@ -1,8 +1,11 @@
 import os
+import glob
+import hashlib
 import logging
-import duckdb
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from db import connect
 
 # Resolve paths relative to this file so the script works no matter
 # where it's invoked from (e.g., CLI, IDE Run button, cron, etc.).
@@ -19,6 +22,19 @@ DB_FILE = next((p for p in CANDIDATE_DB_PATHS if os.path.exists(p)), os.path.joi
 PLOTS_DIR = os.path.join(HERE, "plots"); os.makedirs(PLOTS_DIR, exist_ok=True)
 LOG_FILE = os.path.join(HERE, "analysis.log")
 
+# Development aid: write DuckDB's JSON profile of each aggregation (agg_bucket and
+# every RESULT_QUERIES entry) to its own analysis_profile_<name>.json, e.g. to
+# confirm the aggregates run in parallel. Profiling bypasses the result cache so
+# the aggregations actually run.
+PROFILE_QUERIES = False
+PROFILE_FILE_TEMPLATE = os.path.join(HERE, "analysis_profile_{name}.json")
+
+# Sidecar Parquet copies of the (small) query results, keyed by a signature of
+# trips_features plus the query text, so reruns that only tweak reporting/plots
+# skip the aggregations. Files from older keys are pruned on each cache miss.
+# Kept in their own subdirectory, apart from load.py's raw TLC downloads in cache/.
+CACHE_DIR = os.path.join(HERE, "cache", "analysis")
+
 # Log to file; INFO level is enough for a human-readable run log
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s",
                     filename=LOG_FILE, filemode="w")
@@ -28,58 +44,189 @@ log = logging.getLogger(__name__)
 # ---- SQL QUERIES ----
 
 # 1) For each taxi color, find the single trip with the largest CO2 (in kg).
-#    We use ROW_NUMBER() partitioned by color, ordered by trip_co2_kgs DESC, and pick rn = 1.
+#    arg_max keeps one row of state per color instead of sorting every trip. The
+#    trip fields are packed into one struct so they all come from the same row.
 MAX_TRIP_SQL = """
-WITH ranked AS (
+WITH best AS (
   SELECT
     color,
-    pickup_datetime,
-    dropoff_datetime,
-    trip_distance,
-    trip_co2_kgs,
-    ROW_NUMBER() OVER (PARTITION BY color ORDER BY trip_co2_kgs DESC) AS rn
+    arg_max({'pickup_datetime': pickup_datetime,
+             'dropoff_datetime': dropoff_datetime,
+             'trip_distance': trip_distance}, trip_co2_kgs) AS trip,
+    MAX(trip_co2_kgs) AS trip_co2_kgs
   FROM trips_features
+  GROUP BY color
 )
-SELECT color, pickup_datetime, dropoff_datetime, trip_distance, trip_co2_kgs
-FROM ranked
-WHERE rn = 1
+SELECT color,
+       trip.pickup_datetime  AS pickup_datetime,
+       trip.dropoff_datetime AS dropoff_datetime,
+       trip.trip_distance    AS trip_distance,
+       trip_co2_kgs
+FROM best
 ORDER BY color;
 """
 
-# 2) Template to identify the most/least carbon-heavy "bucket" for a given time unit.
-#    bucket_col is something like hour_of_day, day_of_week, week_of_year, month_of_year.
-#    We compute AVG(trip_co2_kgs) per (color, bucket), rank DESC for heavy and ASC for light, and keep rnk = 1.
-HEAVY_LIGHT_TEMPLATE = """
--- {bucket_name}: per-trip average CO2 across the year
+# 2) Compact rollup of trips_features, built once per uncached run. One row per
+#    (color, hour, day, week, month) with the CO2 sum and trip count, so the
+#    bucket averages and monthly totals below read ~20k rows at most
+#    instead of re-scanning the full table each time.
+AGG_BUCKET_SQL = """
+CREATE OR REPLACE TEMP TABLE agg_bucket AS
+SELECT color, hour_of_day, day_of_week, week_of_year, month_of_year,
+       SUM(trip_co2_kgs) AS co2_sum,
+       COUNT(trip_co2_kgs) AS trips
+FROM trips_features
+GROUP BY 1,2,3,4,5;
+"""
+
+# 3) Identify the most/least carbon-heavy "bucket" for every time unit in one pass.
+#    GROUPING SETS computes AVG(trip_co2_kgs) per (color, bucket) for hour_of_day,
+#    day_of_week, week_of_year and month_of_year in a single aggregation over
+#    agg_bucket (sum / count); dim names which column each row was grouped by.
+#    arg_max / arg_min then pick the heaviest and lightest bucket per (dim, color).
+HEAVY_LIGHT_SQL = """
 WITH agg AS (
-  SELECT color, {bucket_col} AS bucket, AVG(trip_co2_kgs) AS avg_co2
-  FROM trips_features
-  GROUP BY 1,2
-),
-heavy AS (
-  SELECT color, bucket, avg_co2,
-         ROW_NUMBER() OVER (PARTITION BY color ORDER BY avg_co2 DESC) AS rnk
-  FROM agg
+  SELECT
+    color,
+    CASE WHEN GROUPING(hour_of_day)  = 0 THEN 'hour_of_day'
+         WHEN GROUPING(day_of_week)  = 0 THEN 'day_of_week'
+         WHEN GROUPING(week_of_year) = 0 THEN 'week_of_year'
+         ELSE 'month_of_year' END AS dim,
+    CASE WHEN GROUPING(hour_of_day)  = 0 THEN hour_of_day
+         WHEN GROUPING(day_of_week)  = 0 THEN day_of_week
+         WHEN GROUPING(week_of_year) = 0 THEN week_of_year
+         ELSE month_of_year END AS bucket,
+    SUM(co2_sum) / SUM(trips) AS avg_co2
+  FROM agg_bucket
+  GROUP BY GROUPING SETS (
+    (color, hour_of_day),
+    (color, day_of_week),
+    (color, week_of_year),
+    (color, month_of_year)
+  )
 ),
-light AS (
-  SELECT color, bucket, avg_co2,
-         ROW_NUMBER() OVER (PARTITION BY color ORDER BY avg_co2 ASC) AS rnk
+best AS (
+  SELECT dim, color,
+         arg_max(bucket, avg_co2) AS heavy_bucket, MAX(avg_co2) AS heavy_co2,
+         arg_min(bucket, avg_co2) AS light_bucket, MIN(avg_co2) AS light_co2
   FROM agg
+  GROUP BY dim, color
 )
-SELECT 'heavy' AS kind, color, bucket, avg_co2 FROM heavy WHERE rnk = 1
+SELECT dim, 'heavy' AS kind, color, heavy_bucket AS bucket, heavy_co2 AS avg_co2 FROM best
 UNION ALL
-SELECT 'light' AS kind, color, bucket, avg_co2 FROM light WHERE rnk = 1
-ORDER BY color, kind;
+SELECT dim, 'light' AS kind, color, light_bucket AS bucket, light_co2 AS avg_co2 FROM best
+ORDER BY dim, color, kind;
 """
 
-# 3) Monthly totals (sum of CO2 per month per color) to drive the plot.
+# 4) Monthly totals (sum of CO2 per month per color) to drive the plot.
 MONTHLY_TOTALS_SQL = """
-SELECT color, month_of_year AS month, SUM(trip_co2_kgs) AS total_co2_kg
-FROM trips_features
+SELECT color, month_of_year AS month, SUM(co2_sum) AS total_co2_kg
+FROM agg_bucket
 GROUP BY 1,2
 ORDER BY month, color;
 """
 
+# 5) Cheap fingerprint of trips_features; any reload/re-transform changes it.
+#    Only exact values go into it: a parallel floating-point SUM can differ in the
+#    last bits between runs, so distance and CO2 are summed as rounded integers
+#    (hundredths of a mile, grams); the CO2 sum still changes with the emissions rate.
+SIGNATURE_SQL = """
+SELECT COUNT(*),
+       MIN(pickup_datetime),
+       MAX(pickup_datetime),
+       SUM(CAST(ROUND(trip_distance * 100) AS HUGEINT)),
+       SUM(CAST(ROUND(trip_co2_kgs * 1000) AS HUGEINT))
+FROM trips_features;
+"""
+
+# Results cached to Parquet: name -> (query, ORDER BY used when reading back)
+RESULT_QUERIES = {
+    "max_trips":    (MAX_TRIP_SQL,       "color"),
+    "bucket_stats": (HEAVY_LIGHT_SQL,    "dim, color, kind"),
+    "monthly":      (MONTHLY_TOTALS_SQL, "month, color"),
+}
+
+# ---- RESULT CACHE HELPERS -----
+
+def profile_next(con, name):
+    """
+    When PROFILE_QUERIES is on, send the profile of the next statement to
+    PROFILE_FILE_TEMPLATE for name. DuckDB overwrites profiling_output on every
+    statement, so each profiled query needs its own file.
+    """
+    if PROFILE_QUERIES:
+        con.execute("PRAGMA enable_profiling='json'")
+        con.execute(f"PRAGMA profiling_output='{PROFILE_FILE_TEMPLATE.format(name=name)}'")
+
+
+def cached_results(con):
+    """
+    Return {name: parquet path} for every query in RESULT_QUERIES.
+
+    The files are keyed by a hash of SIGNATURE_SQL's result together with the text
+    of AGG_BUCKET_SQL and every query in RESULT_QUERIES, so editing the data or any
+    of the queries invalidates the cache. If all files already exist the
+    aggregations are skipped (unless PROFILE_QUERIES is on); otherwise agg_bucket
+    is built and each result is written with COPY ... (FORMAT PARQUET, COMPRESSION
+    ZSTD) via a .tmp file, so an interrupted run never leaves a partial cache
+    behind. Results cached under older keys are then deleted.
+    """
+    sig = con.execute(SIGNATURE_SQL).fetchone()
+    fingerprint = (sig, AGG_BUCKET_SQL, [sql for sql, _ in RESULT_QUERIES.values()])
+    key = hashlib.md5(repr(fingerprint).encode()).hexdigest()[:12]
+    paths = {name: os.path.join(CACHE_DIR, f"analysis_{name}_{key}.parquet") for name in RESULT_QUERIES}
+
+    if all(os.path.exists(p) for p in paths.values()) and not PROFILE_QUERIES:
+        log.info("Reusing cached analysis results (%s)", key)
+        return paths
+
+    # Build the rollup that the bucket and monthly queries read from
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    try:
+        profile_next(con, "agg_bucket")
+        con.execute(AGG_BUCKET_SQL)
+        for name, (sql, _) in RESULT_QUERIES.items():
+            tmp = paths[name] + ".tmp"
+            try:
+                profile_next(con, name)
+                con.execute(f"COPY ({sql.strip().rstrip(';')}) TO '{tmp}' (FORMAT PARQUET, COMPRESSION ZSTD)")
+                os.replace(tmp, paths[name])
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+    finally:
+        if PROFILE_QUERIES:
+            con.execute("PRAGMA disable_profiling")
+    log.info("Cached analysis results (%s) in %s", key, CACHE_DIR)
+
+    # Drop results cached under older keys so they don't pile up in CACHE_DIR
+    current = set(paths.values())
+    for name in RESULT_QUERIES:
+        for old in glob.glob(os.path.join(CACHE_DIR, f"analysis_{name}_*.parquet")):
+            if old not in current:
+                os.remove(old)
+                log.info("Removed stale cached result %s", old)
+    return paths
+
+
+def read_result(con, paths, name):
+    """
+    Read one cached result back in its original row order; returns the cursor
+    so the caller picks the fetch method (fetchall, fetchdf, fetch_arrow).
+    """
+    return con.execute(f"SELECT * FROM read_parquet(?) ORDER BY {RESULT_QUERIES[name][1]}", [paths[name]])
+
+
+def fetch_arrow(cur):
+    """
+    Fetch a cursor's result as an Arrow table. Newer DuckDB renamed
+    fetch_arrow_table() to to_arrow_table() and warns on the old name,
+    so use whichever this version provides.
+    """
+    if hasattr(cur, "to_arrow_table"):
+        return cur.to_arrow_table()
+    return cur.fetch_arrow_table()
+
 # ---- REPORTING/FORMATTING HELPERS -----
 
 def report_bucket(df, label, formatter):
@@ -89,7 +236,7 @@ def report_bucket(df, label, formatter):
     Parameters
     ----------
     df : pd.DataFrame
-        Output of HEAVY_LIGHT_TEMPLATE (columns: kind, color, bucket, avg_co2)
+        Rows of HEAVY_LIGHT_SQL for one dim (columns: dim, kind, color, bucket, avg_co2)
     label : str
         Human label for the bucket dimension (e.g., 'HOUR', 'DAY-OF-WEEK')
     formatter : callable(int) -> str
@@ -97,42 +244,60 @@ def report_bucket(df, label, formatter):
     """
     print(f"\n=== {label}: Most/Least carbon-heavy (avg CO2 per trip) ===")
     log.info("=== %s: Most/Least carbon-heavy (avg CO2 per trip) ===", label)
-    for color in sorted(df["color"].unique()):
-        sub = df[df["color"] == color]
-        # Each color should have exactly one 'heavy' and one 'light' row
-        heavy = sub[sub["kind"] == "heavy"].iloc[0]
-        light = sub[sub["kind"] == "light"].iloc[0]
+    # Index once by (color, kind); each color has exactly one 'heavy' and one 'light' row
+    g = df.set_index(["color", "kind"]).sort_index()
+    for color in g.index.unique(level="color"):
+        heavy = g.loc[(color, "heavy")]
+        light = g.loc[(color, "light")]
         msg_h = f"{color.upper()} HEAVY {label}: {formatter(int(heavy['bucket']))} (avg {heavy['avg_co2']:.3f} kg/trip)"
         msg_l = f"{color.upper()} LIGHT {label}: {formatter(int(light['bucket']))} (avg {light['avg_co2']:.3f} kg/trip)"
         print(msg_h); print(msg_l)
         log.info(msg_h); log.info(msg_l)
 
 
-def make_monthly_plot(monthly_df, out_path):
+def monthly_arrays(table):
+    """
+    Turn the Arrow table of (color, month, total_co2_kg) from MONTHLY_TOTALS_SQL
+    into one 12-element numpy array per color (index 0 = Jan). Columns are read
+    straight from Arrow as numpy arrays, with no pandas step. Months with no
+    trips stay 0.0.
+    """
+    colors = table.column("color").to_numpy()
+    months = table.column("month").to_numpy().astype(int)
+    totals = table.column("total_co2_kg").to_numpy()
+    monthly = {"yellow": np.zeros(12), "green": np.zeros(12)}
+    for color, series in monthly.items():
+        mask = colors == color
+        series[months[mask] - 1] = totals[mask]
+    return monthly
+
+
+def make_monthly_plot(monthly, out_path):
     """
     Create a dual-axis line chart:
       - Left y-axis: Yellow total CO2 per month
       - Right y-axis: Green total CO2 per month
     Using a twin axis makes both series readable if they differ in magnitude.
 
+    monthly maps color -> 12-element array of totals (see monthly_arrays).
+
     Saves the figure to out_path (PNG).
     """
-    # Pivot to month x color matrix; ensure months 1..12 exist in the index
-    pivot = monthly_df.pivot(index="month", columns="color", values="total_co2_kg").reindex(range(1,13), fill_value=0.0)
+    months = range(1, 13)
     mon_labels = ["Jan","Feb","Mar","Apr","May","Jun","Jul","Aug","Sep","Oct","Nov","Dec"]
 
     fig, ax1 = plt.subplots(figsize=(10, 5))
     ax2 = ax1.twinx()  # second y-axis for the other color
 
     # Plot Yellow on left axis (solid line, gold-ish color)
-    if "yellow" in pivot.columns:
-        ax1.plot(pivot.index, pivot["yellow"], color="#FFB000", marker="o", label="YELLOW")
+    if "yellow" in monthly:
+        ax1.plot(months, monthly["yellow"], color="#FFB000", marker="o", label="YELLOW")
         ax1.set_ylabel("YELLOW Total CO₂ (kg)", color="#FFB000")
         ax1.tick_params(axis="y", colors="#FFB000"); ax1.spines["left"].set_color("#FFB000")
 
     # Plot Green on right axis (dashed line, green color)
-    if "green" in pivot.columns:
-        ax2.plot(pivot.index, pivot["green"], color="#2E7D32", marker="o", linestyle="--", label="GREEN")
+    if "green" in monthly:
+        ax2.plot(months, monthly["green"], color="#2E7D32", marker="o", linestyle="--", label="GREEN")
         ax2.set_ylabel("GREEN Total CO₂ (kg)", color="#2E7D32")
         ax2.tick_params(axis="y", colors="#2E7D32"); ax2.spines["right"].set_color("#2E7D32")
 
@@ -156,43 +321,47 @@ def main():
     con = None
     try:
         # Connect read-only to avoid accidental writes
-        con = duckdb.connect(DB_FILE, read_only=True)
+        con = connect(DB_FILE, read_only=True)
         log.info("Connected to %s", DB_FILE)
 
+        # Every query here has its own ORDER BY, so DuckDB may reorder rows
+        # within pipelines, which allows more parallel aggregation plans
+        con.execute("SET preserve_insertion_order=false")
+
+        # Run the aggregations, or reuse their cached results if trips_features is unchanged
+        results = cached_results(con)
+
         # (1) Largest CO₂ trip per color
-        max_trips = con.execute(MAX_TRIP_SQL).fetchdf()
+        # Only one row per color, so plain tuples are enough (no DataFrame)
+        max_trips = read_result(con, results, "max_trips").fetchall()
         print("\n=== Largest CO₂ trip (per color) ===")
         log.info("Largest CO₂ trip (per color):")
-        for _, r in max_trips.iterrows():
-            msg = (f"{r['color'].upper()}: {r['trip_co2_kgs']:.3f} kg "
-                   f"(dist={r['trip_distance']:.2f} mi, "
-                   f"pickup={r['pickup_datetime']}, dropoff={r['dropoff_datetime']})")
+        for color, pickup, dropoff, dist, co2 in max_trips:
+            msg = (f"{color.upper()}: {co2:.3f} kg "
+                   f"(dist={dist:.2f} mi, "
+                   f"pickup={pickup}, dropoff={dropoff})")
             print(msg); log.info(msg)
 
+        # (2)-(5) Heavy/light buckets for every time unit, fetched once and split by dim
+        bucket_stats = read_result(con, results, "bucket_stats").fetchdf()
+        stats_by_dim = {dim: sub for dim, sub in bucket_stats.groupby("dim")}
+
         # (2) Most/least carbon-heavy HOUR of day
-        hour_stats = con.execute(HEAVY_LIGHT_TEMPLATE.format(
-            bucket_name="hour", bucket_col="hour_of_day")).fetchdf()
-        report_bucket(hour_stats, "HOUR", lambda b: f"{b:02d}:00")
+        report_bucket(stats_by_dim["hour_of_day"], "HOUR", lambda b: f"{b:02d}:00")
 
         # (3) Most/least carbon-heavy DAY OF WEEK (0..6 assumed Sun..Sat)
-        dow_stats = con.execute(HEAVY_LIGHT_TEMPLATE.format(
-            bucket_name="day-of-week", bucket_col="day_of_week")).fetchdf()
         dow_name = ["Sun","Mon","Tue","Wed","Thu","Fri","Sat"]
-        report_bucket(dow_stats, "DAY-OF-WEEK", lambda b: dow_name[b] if 0 <= b <= 6 else str(b))
+        report_bucket(stats_by_dim["day_of_week"], "DAY-OF-WEEK", lambda b: dow_name[b] if 0 <= b <= 6 else str(b))
 
         # (4) Most/least carbon-heavy WEEK of year (1..53 depending on ISO week)
-        week_stats = con.execute(HEAVY_LIGHT_TEMPLATE.format(
-            bucket_name="week", bucket_col="week_of_year")).fetchdf()
-        report_bucket(week_stats, "WEEK", lambda b: f"Week {b}")
+        report_bucket(stats_by_dim["week_of_year"], "WEEK", lambda b: f"Week {b}")
 
         # (5) Most/least carbon-heavy MONTH
-        month_stats = con.execute(HEAVY_LIGHT_TEMPLATE.format(
-            bucket_name="month", bucket_col="month_of_year")).fetchdf()
         mon_name = [None,"Jan","Feb","Mar","Apr","May","Jun","Jul","Aug","Sep","Oct","Nov","Dec"]
-        report_bucket(month_stats, "MONTH", lambda b: mon_name[b] if 1 <= b <= 12 else str(b))
+        report_bucket(stats_by_dim["month_of_year"], "MONTH", lambda b: mon_name[b] if 1 <= b <= 12 else str(b))
 
         # (6) Plot monthly totals to PNG
-        monthly = con.execute(MONTHLY_TOTALS_SQL).fetchdf()
+        monthly = monthly_arrays(fetch_arrow(read_result(con, results, "monthly")))
         out_png = os.path.join(PLOTS_DIR, "monthly_co2.png")
         make_monthly_plot(monthly, out_png)
 
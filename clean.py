@@ -1,5 +1,5 @@
-import duckdb
 import logging
+from db import connect
 
 # Configure logging to file (clean.log) + console output
 logging.basicConfig(
@@ -18,101 +18,91 @@ DB_FILE = "transform.duckdb"
 # Flag to enforce only positive zone IDs (exclude invalid PULocationID / DOLocationID = 0)
 ENFORCE_POSITIVE_ZONES = False
 
+# Timestamp column prefix per color: Yellow uses tpep_*, Green uses lpep_*
+TIMESTAMP_PREFIX = {"yellow": "tpep", "green": "lpep"}
+
 
 # ---------- SQL TEMPLATE FUNCTIONS ----------
 
-def make_yellow_sql(zone_clause: str) -> str:
+def make_color_select(color: str, zone_clause: str) -> str:
     """
-    Build SQL query to clean Yellow Taxi trips:
-      - Keep only 2024 trips.
+    Build the filtered SELECT for one taxi color's trips:
+      - Rows are already limited to 2024 pickups by load.py's scan.
       - Enforce valid times (pickup <= dropoff, duration <= 24h).
       - Keep only realistic trip distances, fares, passenger counts.
       - Optionally enforce positive zone IDs.
-      - Deduplicate identical rows.
+    Yellow and Green share one template; only the timestamp prefix differs
+    (tpep_* vs lpep_*). Predicates run on the raw columns, so the casts are
+    only applied to rows that survive the filter.
     """
+    ts = TIMESTAMP_PREFIX[color]
     return f"""
-CREATE OR REPLACE TABLE yellow_trips_2024_clean AS
-WITH base AS (
   SELECT
-    tpep_pickup_datetime  AS pickup_datetime,
-    tpep_dropoff_datetime AS dropoff_datetime,
+    '{color}' AS color,
+    {ts}_pickup_datetime  AS pickup_datetime,
+    {ts}_dropoff_datetime AS dropoff_datetime,
     CAST(passenger_count AS INTEGER) AS passenger_count,
     CAST(trip_distance   AS DOUBLE)  AS trip_distance,
     CAST(VendorID        AS INTEGER) AS vendor_id,
     CAST(PULocationID    AS INTEGER) AS pu_location_id,
     CAST(DOLocationID    AS INTEGER) AS do_location_id,
     CAST(total_amount    AS DOUBLE)  AS total_amount
-  FROM yellow_trips_2024
-  WHERE tpep_pickup_datetime >= TIMESTAMP '2024-01-01'
-    AND tpep_pickup_datetime <  TIMESTAMP '2025-01-01'
-),
-filtered AS (
-  SELECT *
-  FROM base
-  WHERE pickup_datetime <= dropoff_datetime
-    AND (dropoff_datetime - pickup_datetime) BETWEEN INTERVAL 0 MINUTE AND INTERVAL 24 HOUR
+  FROM {color}_trips_2024  -- already limited to 2024 pickups by load.py
+  WHERE {ts}_pickup_datetime <= {ts}_dropoff_datetime
+    AND ({ts}_dropoff_datetime - {ts}_pickup_datetime) BETWEEN INTERVAL 0 MINUTE AND INTERVAL 24 HOUR
     AND trip_distance > 0 AND trip_distance <= 100
     AND passenger_count BETWEEN 1 AND 6
     AND total_amount BETWEEN 0 AND 1000
     {zone_clause}  -- optionally enforce pu/do location > 0
-)
-SELECT *
-FROM filtered
--- Deduplication: keep only 1 row if identical across key fields
-QUALIFY ROW_NUMBER() OVER (
-  PARTITION BY pickup_datetime, dropoff_datetime, trip_distance,
-               pu_location_id, do_location_id, vendor_id, total_amount, passenger_count
-  ORDER BY pickup_datetime
-) = 1;
 """
 
 
-def make_green_sql(zone_clause: str) -> str:
+def make_clean_sql(zone_clause: str) -> str:
     """
-    Same as make_yellow_sql but adapted for Green Taxi schema
-    (lpep_* timestamps instead of tpep_*).
+    Build SQL that creates trips_2024_clean straight from the raw Yellow and
+    Green tables in one statement (no per-color intermediate tables):
+      - UNION ALL of each color's filtered SELECT.
+      - Deduplicate identical rows with one DISTINCT over the union
+        (color is part of the key, so colors are deduplicated separately).
+      - Store sorted by (color, pickup_datetime) so each row group covers one
+        color and a narrow time range, letting DuckDB's min/max zone maps skip
+        row groups for color- or time-filtered scans.
     """
+    selects = "  UNION ALL".join(make_color_select(color, zone_clause) for color in TIMESTAMP_PREFIX)
     return f"""
-CREATE OR REPLACE TABLE green_trips_2024_clean AS
-WITH base AS (
-  SELECT
-    lpep_pickup_datetime  AS pickup_datetime,
-    lpep_dropoff_datetime AS dropoff_datetime,
-    CAST(passenger_count AS INTEGER) AS passenger_count,
-    CAST(trip_distance   AS DOUBLE)  AS trip_distance,
-    CAST(VendorID        AS INTEGER) AS vendor_id,
-    CAST(PULocationID    AS INTEGER) AS pu_location_id,
-    CAST(DOLocationID    AS INTEGER) AS do_location_id,
-    CAST(total_amount    AS DOUBLE)  AS total_amount
-  FROM green_trips_2024
-  WHERE lpep_pickup_datetime >= TIMESTAMP '2024-01-01'
-    AND lpep_pickup_datetime <  TIMESTAMP '2025-01-01'
-),
-filtered AS (
-  SELECT *
-  FROM base
-  WHERE pickup_datetime <= dropoff_datetime
-    AND (dropoff_datetime - pickup_datetime) BETWEEN INTERVAL 0 MINUTE AND INTERVAL 24 HOUR
-    AND trip_distance > 0 AND trip_distance <= 100
-    AND passenger_count BETWEEN 1 AND 6
-    AND total_amount BETWEEN 0 AND 1000
-    {zone_clause}
-)
-SELECT *
-FROM filtered
-QUALIFY ROW_NUMBER() OVER (
-  PARTITION BY pickup_datetime, dropoff_datetime, trip_distance,
-               pu_location_id, do_location_id, vendor_id, total_amount, passenger_count
-  ORDER BY pickup_datetime
-) = 1;
+CREATE OR REPLACE TABLE trips_2024_clean AS
+SELECT DISTINCT *
+FROM ({selects})
+ORDER BY color, pickup_datetime;
 """
 
-# SQL to combine Yellow + Green into one cleaned table
-COMBINE_SQL = """
-CREATE OR REPLACE TABLE trips_2024_clean AS
-SELECT 'yellow' AS color, * FROM yellow_trips_2024_clean
-UNION ALL
-SELECT 'green'  AS color, * FROM green_trips_2024_clean;
+# Verification checks over trips_2024_clean in a single scan.
+# g groups identical trips (all 9 columns) so duplicates are c > 1; every
+# other check only depends on those columns, so it is summed from g too.
+# GROUPING SETS returns one row per color (row counts) plus a grand-total
+# row with color = NULL (time span, bad-value counts, duplicates).
+CHECKS_SQL = """
+WITH g AS (
+  SELECT color, pickup_datetime, dropoff_datetime, passenger_count,
+         trip_distance, vendor_id, pu_location_id, do_location_id, total_amount,
+         COUNT(*) AS c
+  FROM trips_2024_clean
+  GROUP BY 1,2,3,4,5,6,7,8,9
+)
+SELECT
+  color,
+  SUM(c) AS rows,
+  MIN(pickup_datetime) AS min_pickup,
+  MAX(pickup_datetime) AS max_pickup,
+  COALESCE(SUM(c) FILTER (WHERE passenger_count = 0), 0) AS zero_passengers,
+  COALESCE(SUM(c) FILTER (WHERE trip_distance <= 0), 0) AS zero_or_neg_distance,
+  COALESCE(SUM(c) FILTER (WHERE trip_distance  > 100), 0) AS over_100_miles,
+  COALESCE(SUM(c) FILTER (WHERE dropoff_datetime < pickup_datetime), 0) AS negative_duration,
+  COALESCE(SUM(c) FILTER (WHERE (dropoff_datetime - pickup_datetime) > INTERVAL 24 HOUR), 0) AS over_24h,
+  COALESCE(SUM(c - 1) FILTER (WHERE c > 1), 0) AS duplicates
+FROM g
+GROUP BY GROUPING SETS ((color), ())
+ORDER BY color NULLS LAST;
 """
 
 # ---------- MAIN CLEANING PIPELINE ----------
@@ -121,62 +111,36 @@ def main():
     con = None
     try:
         # Connect to DuckDB file
-        con = duckdb.connect(DB_FILE, read_only=False)
+        con = connect(DB_FILE, read_only=False)
         log.info("Connected to %s", DB_FILE)
 
         # Add zone clause if enforcing positive zone IDs
-        zone_clause = "AND pu_location_id > 0 AND do_location_id > 0" if ENFORCE_POSITIVE_ZONES else ""
-
-        # Clean Yellow Taxi table
-        con.execute(make_yellow_sql(zone_clause))
-        yc = con.execute("SELECT COUNT(*) FROM yellow_trips_2024_clean").fetchone()[0]
-        log.info("yellow_trips_2024_clean rows: %s", f"{yc:,}")
-
-        # Clean Green Taxi table
-        con.execute(make_green_sql(zone_clause))
-        gc = con.execute("SELECT COUNT(*) FROM green_trips_2024_clean").fetchone()[0]
-        log.info("green_trips_2024_clean rows: %s", f"{gc:,}")
-
-        # Combine both into trips_2024_clean
-        con.execute(COMBINE_SQL)
-
-        # Row counts by color
-        rows_by_color = con.execute("""
-            SELECT color, COUNT(*) AS rows
-            FROM trips_2024_clean
-            GROUP BY 1 ORDER BY 1;
-        """).fetchall()
+        zone_clause = "AND PULocationID > 0 AND DOLocationID > 0" if ENFORCE_POSITIVE_ZONES else ""
+
+        # Drop per-color clean tables left by earlier versions of this script;
+        # trips_2024_clean is now built directly and nothing reads them
+        for color in TIMESTAMP_PREFIX:
+            con.execute(f"DROP TABLE IF EXISTS {color}_trips_2024_clean;")
+
+        # Clean Yellow + Green into trips_2024_clean in one statement
+        con.execute(make_clean_sql(zone_clause))
+
+        # Row counts, time range, bad-value counts and duplicates in one scan
+        checks = con.execute(CHECKS_SQL).fetchall()
+        totals = checks[-1]  # grand-total row (color = NULL) sorts last
+        rows_by_color = [(r[0], r[1]) for r in checks[:-1]]
         log.info("trips_2024_clean rows by color: %s", rows_by_color)
 
         # Time range of dataset
-        span = con.execute("""
-            SELECT MIN(pickup_datetime), MAX(pickup_datetime) FROM trips_2024_clean;
-        """).fetchone()
+        span = (totals[2], totals[3])
         log.info("pickup_datetime range: %s", span)
 
         # Sanity checks: count bad values
-        bads = con.execute("""
-          SELECT
-            COUNT(*) FILTER (WHERE passenger_count = 0) AS zero_passengers,
-            COUNT(*) FILTER (WHERE trip_distance <= 0) AS zero_or_neg_distance,
-            COUNT(*) FILTER (WHERE trip_distance  > 100) AS over_100_miles,
-            COUNT(*) FILTER (WHERE dropoff_datetime < pickup_datetime) AS negative_duration,
-            COUNT(*) FILTER (WHERE (dropoff_datetime - pickup_datetime) > INTERVAL 24 HOUR) AS over_24h
-          FROM trips_2024_clean;
-        """).fetchone()
+        bads = tuple(totals[4:9])
         log.info("bad-value counts: %s", bads)
 
         # Check for duplicates that slipped through deduplication
-        dupes = con.execute("""
-          WITH g AS (
-            SELECT color, pickup_datetime, dropoff_datetime, passenger_count,
-                   trip_distance, vendor_id, pu_location_id, do_location_id, total_amount,
-                   COUNT(*) AS c
-            FROM trips_2024_clean
-            GROUP BY 1,2,3,4,5,6,7,8,9
-          )
-          SELECT COALESCE(SUM(c-1),0) FROM g WHERE c>1;
-        """).fetchone()[0]
+        dupes = totals[9]
         log.info("duplicates remaining: %s", dupes)
 
     except Exception as e:
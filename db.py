@@ -0,0 +1,38 @@
+import os
+import tempfile
+import duckdb
+
+# Share of physical RAM DuckDB may use before spilling to TEMP_DIR
+MEMORY_FRACTION = 0.8
+# Where DuckDB spills large hash aggregates/sorts instead of running out of memory
+TEMP_DIR = os.path.join(tempfile.gettempdir(), "duckdb_spill")
+
+
+def memory_limit():
+    """
+    Return MEMORY_FRACTION of physical RAM as a DuckDB size string (e.g. '12GB'),
+    or None if the platform doesn't expose total memory.
+    """
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+    return f"{max(1, int(total * MEMORY_FRACTION / 1024**3))}GB"
+
+
+def connect(path, read_only=False):
+    """
+    Open a DuckDB connection tuned for the pipeline scripts:
+      - one thread per CPU so scans and hash aggregates run in parallel,
+      - an explicit memory limit plus a temp directory so big aggregates spill,
+      - the object cache so Parquet/table metadata is reused across statements.
+    Used by load.py, clean.py and analysis.py.
+    """
+    con = duckdb.connect(path, read_only=read_only)
+    con.execute(f"PRAGMA threads={os.cpu_count() or 1}")
+    limit = memory_limit()
+    if limit is not None:
+        con.execute(f"PRAGMA memory_limit='{limit}'")
+    con.execute(f"PRAGMA temp_directory='{TEMP_DIR}'")
+    con.execute("PRAGMA enable_object_cache=true")
+    return con
@@ -1,11 +1,27 @@
 import os
-import duckdb
+import time
+import shutil
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 import logging
+from db import connect
 
 # Year and months we want to process
 YEAR = 2024
 MONTHS = range(1, 13)   # January (1) through December (12)
 DB_FILE = "transform.duckdb"  # Local DuckDB file to persist data
+# Local copies of the monthly TLC Parquet files, next to this script (like analysis.py's
+# paths) so running from another directory reuses the same cache
+HERE = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(HERE, "cache")
+PARQUET_MAGIC = b"PAR1"       # Parquet files start and end with these bytes
+HTTP_TIMEOUT = 60             # Seconds before a stalled connection/read gives up
+HTTP_RETRIES = 3              # Attempts per file for transient network/server errors
+MISSING_STATUSES = (403, 404) # How the TLC CDN answers for a month not published
+
+# Print EXPLAIN ANALYZE for each scan to confirm the year filter reaches read_parquet
+VERIFY_PUSHDOWN = False
 
 # Columns we care about for each dataset
 # Yellow taxi schema
@@ -31,6 +47,12 @@ GREEN_COLS = """
     total_amount
 """
 
+# Pickup timestamp column per color, used to keep only trips in YEAR at scan time
+PICKUP_COLS = {
+    "yellow": "tpep_pickup_datetime",
+    "green": "lpep_pickup_datetime",
+}
+
 def tlc_url(color, year, month):
     """
     Build the official TLC (Taxi & Limousine Commission) data URL
@@ -40,79 +62,124 @@ def tlc_url(color, year, month):
     """
     return f"https://d37ci6vzurychx.cloudfront.net/trip-data/{color}_tripdata_{year}-{month:02d}.parquet"
 
-def install_httpfs(con):
+def is_valid_parquet(path):
     """
-    DuckDB needs the httpfs extension to read Parquet files over HTTP/HTTPS.
-    This function installs and loads that extension.
+    Cheap sanity check on a downloaded file: big enough to hold a footer,
+    and starts and ends with the Parquet magic bytes (a truncated or HTML
+    error response fails this).
     """
-    con.execute("INSTALL httpfs;")
-    con.execute("LOAD httpfs;")
-
-def create_from_first_available_month(con, table, select_cols, color):
+    if os.path.getsize(path) < 2 * len(PARQUET_MAGIC) + 4:
+        return False
+    with open(path, "rb") as f:
+        head = f.read(len(PARQUET_MAGIC))
+        f.seek(-len(PARQUET_MAGIC), os.SEEK_END)
+        tail = f.read(len(PARQUET_MAGIC))
+    return head == PARQUET_MAGIC and tail == PARQUET_MAGIC
+
+def download(url, dest):
     """
-    Try to CREATE the DuckDB table from the first available month (Jan–Dec).
-    Stops after the first success. Returns the month used (int), or None if none worked.
+    Stream url into dest, retrying transient failures (connection errors,
+    timeouts, 5xx responses) up to HTTP_RETRIES times with exponential backoff.
+    A 4xx response (e.g. 403/404 for a missing month) is raised immediately,
+    since retrying won't change it.
     """
-    for m in MONTHS:
-        url = tlc_url(color, YEAR, m)
+    for attempt in range(1, HTTP_RETRIES + 1):
         try:
-            # Create (or replace) the table from a single month’s Parquet file
-            con.execute(f"""
-                CREATE OR REPLACE TABLE {table} AS
-                SELECT {select_cols}
-                FROM read_parquet('{url}');
-            """)
-            print(f"[{color}] created {table} from {YEAR}-{m:02d}")
-            return m
-        except Exception as e:
-            # If this month’s file doesn’t exist or fails, skip and continue
-            print(f"[{color}] create skip {YEAR}-{m:02d}: {e}")
-    return None
-
-def append_remaining_months(con, table, select_cols, color, skip_month):
+            with urllib.request.urlopen(url, timeout=HTTP_TIMEOUT) as resp, open(dest, "wb") as f:
+                shutil.copyfileobj(resp, f)
+            return
+        except urllib.error.HTTPError as e:
+            if e.code < 500 or attempt == HTTP_RETRIES:
+                raise
+            err = e
+        except (urllib.error.URLError, TimeoutError, ConnectionError) as e:
+            if attempt == HTTP_RETRIES:
+                raise
+            err = e
+        wait = 2 ** attempt
+        print(f"retry {attempt}/{HTTP_RETRIES - 1} for {url} in {wait}s: {err}")
+        time.sleep(wait)
+
+def fetch_cached(url, cache_dir=CACHE_DIR):
+    """
+    Return the local path of url's Parquet file, downloading it into cache_dir
+    only if it isn't already cached. TLC monthly files are immutable, so later
+    runs skip the network entirely. Downloads go to a .tmp file and are renamed
+    once complete, so an interrupted run never leaves a partial file behind.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, os.path.basename(url))
+    if os.path.exists(path) and is_valid_parquet(path):
+        return path
+    tmp = path + ".tmp"
+    try:
+        download(url, tmp)
+        if not is_valid_parquet(tmp):
+            raise ValueError(f"downloaded file is not valid Parquet: {url}")
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return path
+
+def cached_months(color):
     """
-    Append all the other months into the table,
-    skipping the one already used for CREATE.
+    Fetch every month's file for color into the local cache (in parallel) and
+    return (month, path) pairs for the months that succeeded. Only months the
+    server reports as missing (403/404) are skipped; any other failure is
+    raised, so a flaky connection can't silently load less than a full year.
     """
-    for m in MONTHS:
-        if skip_month is not None and m == skip_month:
-            continue
-        url = tlc_url(color, YEAR, m)
+    def fetch(m):
         try:
-            con.execute(f"""
-                INSERT INTO {table}
-                SELECT {select_cols}
-                FROM read_parquet('{url}');
-            """)
-            print(f"[{color}] inserted {YEAR}-{m:02d}")
-        except Exception as e:
-            # If a month file doesn’t exist or fails, log and move on
-            print(f"[{color}] insert skip {YEAR}-{m:02d}: {e}")
+            return fetch_cached(tlc_url(color, YEAR, m))
+        except urllib.error.HTTPError as e:
+            if e.code not in MISSING_STATUSES:
+                raise
+            # This month's file isn't published; log and move on
+            print(f"[{color}] skip {YEAR}-{m:02d}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=12) as pool:
+        paths = list(pool.map(fetch, MONTHS))
+    return [(m, p) for m, p in zip(MONTHS, paths) if p is not None]
 
 def load_one_color(con, color):
     """
     Load all months of data for one taxi color (yellow or green).
     Process:
-      1. Drop old table if it exists.
-      2. Create table from the first available month.
-      3. Append the rest of the months.
-      4. Report the total row count.
+      1. Make sure each available month is in the local cache.
+      2. Create the table from all of them in a single read_parquet scan,
+         so DuckDB reads the files in parallel. Only the needed columns
+         and only trips picked up in YEAR are read, so row groups outside
+         the year are pruned from their min/max statistics.
+      3. Report the total row count.
     """
     table = f"{color}_trips_{YEAR}"
     select_cols = YELLOW_COLS if color == "yellow" else GREEN_COLS
+    pickup_col = PICKUP_COLS[color]
 
     # Drop any old version of this table to start fresh
     con.execute(f"DROP TABLE IF EXISTS {table};")
     print(f"[{color}] dropped {table} if existed")
 
-    # Create from the first available month
-    created_month = create_from_first_available_month(con, table, select_cols, color)
-    if created_month is None:
-        print(f"[{color}] ERROR: could not create {table} from any 2024 month")
+    found = cached_months(color)
+    if not found:
+        print(f"[{color}] ERROR: could not create {table} from any {YEAR} month")
         return
-
-    # Append the rest
-    append_remaining_months(con, table, select_cols, color, skip_month=created_month)
+    paths = [path for _, path in found]
+
+    # One scan over every month replaces the old CREATE + 11 INSERTs
+    scan_sql = f"""
+        SELECT {select_cols}
+        FROM read_parquet(?, union_by_name=true, filename=false)
+        WHERE {pickup_col} >= TIMESTAMP '{YEAR}-01-01'
+          AND {pickup_col} <  TIMESTAMP '{YEAR + 1}-01-01'
+    """
+    if VERIFY_PUSHDOWN:
+        plan = con.execute(f"EXPLAIN ANALYZE {scan_sql}", [paths]).fetchall()
+        print(f"[{color}] scan plan:\n{plan[0][1]}")
+    con.execute(f"CREATE OR REPLACE TABLE {table} AS {scan_sql};", [paths])
+    print(f"[{color}] created {table} from months {', '.join(f'{m:02d}' for m, _ in found)}")
 
     # Count rows and print summary
     cnt = con.execute(f"SELECT COUNT(*) FROM {table};").fetchone()[0]
@@ -122,19 +189,15 @@ def duckdb_read_parquet():
     """
     Main driver function:
       - Connect to DuckDB.
-      - Enable httpfs for remote reads.
       - Load Yellow and Green taxi datasets.
       - Close connection cleanly.
     """
     con = None
     try:
         # Connect (creates the DB file if not exists)
-        con = duckdb.connect(database=DB_FILE, read_only=False)
+        con = connect(DB_FILE, read_only=False)
         print(f"DuckDB connection established at {DB_FILE}")
 
-        # Enable https parquet reads
-        install_httpfs(con)
-
         # Load Yellow taxi trips for 2024
         load_one_color(con, "yellow")
 